@@ -1,28 +1,155 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from paddleocr import PaddleOCR
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import concurrent.futures
 import tempfile
 import os
-from typing import List, Dict, Any, Optional, Tuple
+import contextlib
+import hashlib
+from typing import List, Dict, Any, Optional, Tuple, Union, Iterator, Iterable
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
 import re
-import json
+import logging
+import functools
+import itertools
+import queue
+import threading
 import fitz  # PyMuPDF
+import ahocorasick
+import numpy as np
+import orjson
 from PIL import Image
 import io
 import base64
 import uuid
 from datetime import datetime
+from urllib.parse import quote
+from overlay import apply_overlay, plan_overlay, shutdown_pool
+
+logger = logging.getLogger(__name__)
+
+# PaddleOCR instance shared by every request. Built at startup, once per
+# server process, not at import: processes that only import this module
+# (such as multiprocessing children re-running it as __mp_main__) never
+# load Paddle or the model
+ocr = None
+
+
+def _load_ocr():
+    """
+    Build the PaddleOCR instance
+    These must be set here: Paddle allocates its memory arenas on the first
+    predictor.run(), sized by the batch settings in effect at construction.
+    - rec_batch_num/cls_batch_num=1: the CPU predictor runs batches sequentially
+      anyway, so larger batches only inflate peak memory
+    - enable_mkldnn: oneDNN-accelerated det/rec convolutions on x86
+    - cpu_threads: the default of 10 oversubscribes small Cloud Run instances
+    - det_limit_side_len: pinned so the detector input size can't drift upward
+    """
+    from paddleocr import PaddleOCR
+    
+    return PaddleOCR(
+        use_gpu=False,
+        use_angle_cls=True,
+        lang='en',
+        rec_batch_num=1,
+        cls_batch_num=1,
+        det_limit_side_len=960,
+        enable_mkldnn=True,
+        cpu_threads=max(2, (os.cpu_count() or 2) // 2),
+        show_log=False
+    )
+
+
+# Page render scale for OCR (1.0 = 72 DPI); PaddleOCR's detector downsizes large
+# inputs anyway, so rendering finer than this mostly adds pixels to push around
+OCR_RENDER_SCALE = float(os.environ.get("OCR_RENDER_SCALE", 1.5))
+
+# Longest edge (px) of a rendered page fed to OCR
+MAX_RENDER_EDGE = 2048.0
+
+# PDF uploads up to this size are opened from memory; larger ones are spooled to disk
+PDF_IN_MEMORY_MAX = 16 * 1024 * 1024
+
+# Extraction results kept per process, keyed by upload content hash
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))
+
+# ...and at most this many fields across all of them (roughly 1 KB of dicts each)
+RESULT_CACHE_MAX_FIELDS = int(os.environ.get("RESULT_CACHE_MAX_FIELDS", 20000))
+
+# Repaired overlay templates kept per process, keyed by upload content hash
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", 32))
+
+# ...and at most this many bytes of them in total
+TEMPLATE_CACHE_BYTES = int(os.environ.get("TEMPLATE_CACHE_BYTES", 64 * 1024 * 1024))
+
+# Uploads larger than this are repaired per request rather than cached
+TEMPLATE_MAX_BYTES = 8 * 1024 * 1024
+
+# Request bodies larger than this are rejected with 413 before any PDF work
+# (the default matches Cloud Run's request size limit)
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 32 * 1024 * 1024))
+
+# OCR/PyMuPDF work (including /overlay) runs here, off the event loop, so
+# /health and new uploads are still served while a large PDF is processed.
+# One worker: PyMuPDF is not thread-safe across documents and PaddleOCR is a
+# single shared instance. Created at startup so every uvicorn worker process
+# owns its own
+_EXECUTOR: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """Start this server process's executor and OCR model; stop the executors on shutdown"""
+    global _EXECUTOR, ocr
+    _EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    ocr = _load_ocr()
+    try:
+        yield
+    finally:
+        _EXECUTOR.shutdown()
+        _EXECUTOR = None
+        shutdown_pool()
 
-# Initialize PaddleOCR globally (once at startup, not per request)
-ocr = PaddleOCR(use_gpu=False, use_angle_cls=True, lang='en')
 
 app = FastAPI(
     title="Document AI - Hybrid Worker",
     description="AcroForm detection with OCR fallback for PDF field extraction",
-    version="3.0.0"
+    version="3.0.0",
+    lifespan=_lifespan,
+    # orjson encodes the large, float-heavy field lists several times faster
+    default_response_class=ORJSONResponse
 )
 
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized uploads from their Content-Length, before the body is read
+    Plain ASGI: @app.middleware("http") would add a task and a stream hop to
+    every request, /health included
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES:
+                        response = ORJSONResponse(status_code=413, content={"detail": "File too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+
+# Added before CORS so CORS stays outermost and the 413 still carries its headers
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Enable CORS for React Native
 app.add_middleware(
     CORSMiddleware,
@@ -33,12 +160,30 @@ app.add_middleware(
 )
 
 
+def _check_upload_size(file: UploadFile) -> None:
+    """Same limit for uploads sent without a Content-Length (chunked), once received"""
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Cloud Run"""
     return {"status": "ok", "version": "3.0.0", "worker": "hybrid"}
 
 
+# PyMuPDF widget type -> field type
+_WIDGET_TYPES = {
+    fitz.PDF_WIDGET_TYPE_TEXT: "text_field",
+    fitz.PDF_WIDGET_TYPE_BUTTON: "checkbox",
+    fitz.PDF_WIDGET_TYPE_CHECKBOX: "checkbox",
+    fitz.PDF_WIDGET_TYPE_RADIOBUTTON: "radio",
+    fitz.PDF_WIDGET_TYPE_COMBOBOX: "dropdown",
+    fitz.PDF_WIDGET_TYPE_LISTBOX: "listbox",
+    fitz.PDF_WIDGET_TYPE_SIGNATURE: "signature",
+}
+
+
 def detect_acroform_fields(doc: fitz.Document) -> Tuple[bool, List[Dict[str, Any]]]:
     """
     Detect AcroForm fields in PDF
@@ -47,16 +192,8 @@ def detect_acroform_fields(doc: fitz.Document) -> Tuple[bool, List[Dict[str, Any
     field_regions = []
     
     try:
-        # Check if PDF has AcroForm
-        if not doc.catalog or "AcroForm" not in doc.catalog:
-            return False, []
-        
-        acro_form = doc.catalog["AcroForm"]
-        if not acro_form or "Fields" not in acro_form:
-            return False, []
-        
-        fields = acro_form["Fields"]
-        if not fields or len(fields) == 0:
+        # Check if PDF has AcroForm fields (False, or the number of fields)
+        if not doc.is_form_pdf:
             return False, []
         
         # Iterate through pages to find widget annotations
@@ -64,68 +201,41 @@ def detect_acroform_fields(doc: fitz.Document) -> Tuple[bool, List[Dict[str, Any
             page = doc[page_num]
             page_width = page.rect.width
             page_height = page.rect.height
+            page_field_idx = 0  # Index of the field within this page, for ids
             
-            # Get all widget annotations on this page
-            for annot in page.annots():
-                if not annot:
-                    continue
-                
-                # Check if it's a form field widget
-                if annot.type[0] != fitz.PDF_ANNOT_WIDGET:
-                    continue
-                
-                # Get field information
-                field_info = annot.info
-                rect = annot.rect
+            # Only form field widgets; other annotations are never touched
+            for widget in page.widgets():
+                # Rect attributes are property lookups; read the corners once
+                x0, y0, x1, y1 = widget.rect
                 
                 # Extract field properties
-                field_type = annot.field_type  # 1=Text, 2=Button, 3=Choice, etc.
-                field_name = annot.field_name or f"field_{page_num}_{len(field_regions)}"
-                field_value = annot.field_value or ""
-                field_label = annot.field_label or field_name
-                
-                # Map field types
-                type_mapping = {
-                    fitz.PDF_WIDGET_TYPE_TEXT: "text_field",
-                    fitz.PDF_WIDGET_TYPE_BUTTON: "checkbox",
-                    fitz.PDF_WIDGET_TYPE_CHECKBOX: "checkbox",
-                    fitz.PDF_WIDGET_TYPE_RADIOBUTTON: "radio",
-                    fitz.PDF_WIDGET_TYPE_COMBOBOX: "dropdown",
-                    fitz.PDF_WIDGET_TYPE_LISTBOX: "listbox",
-                    fitz.PDF_WIDGET_TYPE_SIGNATURE: "signature",
-                }
-                
-                field_type_str = type_mapping.get(field_type, "text_field")
-                
-                # Normalize coordinates (0-1 range)
-                normalized_rect = {
-                    "x": rect.x0 / page_width,
-                    "y": rect.y0 / page_height,
-                    "width": (rect.x1 - rect.x0) / page_width,
-                    "height": (rect.y1 - rect.y0) / page_height
-                }
+                field_type = widget.field_type  # 1=Text, 2=Button, 3=Choice, etc.
+                field_name = widget.field_name or f"field_{page_num}_{page_field_idx}"
+                field_value = widget.field_value or ""
+                field_label = widget.field_label or field_name
                 
-                # Absolute coordinates
-                absolute_rect = {
-                    "x0": rect.x0,
-                    "y0": rect.y0,
-                    "x1": rect.x1,
-                    "y1": rect.y1
-                }
+                field_type_str = _WIDGET_TYPES.get(field_type, "text_field")
                 
-                field_region = {
-                    "id": f"acro_{page_num}_{len(field_regions)}",
+                # One literal per field; the nested rects are the documented wire format
+                field_regions.append({
+                    "id": f"acro_{page_num}_{page_field_idx}",
                     "page": page_num + 1,
                     "type": field_type_str,
                     "name": field_name,
                     "label": field_label,
                     "value": field_value,
-                    "rect_normalized": normalized_rect,
-                    "rect_absolute": absolute_rect,
+                    # Normalized coordinates (0-1 range)
+                    "rect_normalized": {
+                        "x": x0 / page_width,
+                        "y": y0 / page_height,
+                        "width": (x1 - x0) / page_width,
+                        "height": (y1 - y0) / page_height
+                    },
+                    # Absolute coordinates
+                    "rect_absolute": {"x0": x0, "y0": y0, "x1": x1, "y1": y1},
                     "source": "acroform"
-                }
-                
-                field_regions.append(field_region)
+                })
+                page_field_idx += 1
         
         # Return True if we found any fields
         return len(field_regions) > 0, field_regions
@@ -135,34 +245,29 @@ def detect_acroform_fields(doc: fitz.Document) -> Tuple[bool, List[Dict[str, Any
         return False, []
 
 
+# Keyword patterns for infer_field_type_from_ocr, compiled once; checked in order
+_OCR_CHECKBOX_RE = re.compile(r'^\s*[\[\]☐☑✓✗xX○●]|(?:yes|no|male|female|mr|ms|mrs|dr)$')
+_OCR_SIGNATURE_RE = re.compile(r'signature|sign here|signed')
+_OCR_DATE_RE = re.compile(r'date|dd/mm|mm/dd|yyyy')
+
+
 def infer_field_type_from_ocr(text: str, bbox: List[float], nearby_texts: List[str] = None) -> str:
     """Infer field type from OCR text and context"""
     text_lower = text.lower().strip()
     
     # Checkbox patterns
-    checkbox_patterns = [
-        r'^\s*[\[\]☐☑✓✗xX○●]\s*',
-        r'(yes|no|male|female|mr|ms|mrs|dr)$',
-    ]
-    for pattern in checkbox_patterns:
-        if re.search(pattern, text_lower):
-            return "checkbox"
+    if _OCR_CHECKBOX_RE.search(text_lower):
+        return "checkbox"
     
     # Signature field
-    if any(keyword in text_lower for keyword in ['signature', 'sign here', 'signed']):
+    if _OCR_SIGNATURE_RE.search(text_lower):
         return "signature"
     
     # Date field
-    if any(keyword in text_lower for keyword in ['date', 'dd/mm', 'mm/dd', 'yyyy']):
+    if _OCR_DATE_RE.search(text_lower):
         return "date_field"
     
-    # Text field (ends with colon or common field names)
-    if text.endswith(':') or any(keyword in text_lower for keyword in [
-        'name', 'address', 'email', 'phone', 'contact', 'nric', 'ic', 'passport'
-    ]):
-        return "text_field"
-    
-    # Default
+    # Text field (ends with colon or common field names), which is also the default
     return "text_field"
 
 
@@ -172,88 +277,167 @@ def detect_fields_via_ocr(doc: fitz.Document) -> List[Dict[str, Any]]:
     """
     field_regions = []
     
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        page_width = page.rect.width
-        page_height = page.rect.height
+    # Pages are rendered on a background thread while the previous one is OCR'd
+    for img_data in pipelined_pages(doc):
+        page_num = img_data["page"] - 1
+        page_width = img_data["width"]
+        page_height = img_data["height"]
+        scale = img_data["dpi_scale"]
         
-        # Render page to image at 2x resolution
-        mat = fitz.Matrix(2, 2)
-        pix = page.get_pixmap(matrix=mat)
+        # Run OCR (PaddleOCR 2.x takes one image per call when detection is enabled)
+        result = ocr.ocr(img_data["image"], cls=True)
         
-        # Convert to PIL Image
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
+        if not result or not result[0]:
+            continue
         
-        # Save to temp file for OCR
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
-            img.save(tmp.name, 'PNG')
-            temp_path = tmp.name
+        lines = result[0]
         
-        try:
-            # Run OCR
-            result = ocr.ocr(temp_path, cls=True)
-            
-            if result and result[0]:
-                for idx, line in enumerate(result[0]):
-                    box = line[0]  # [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]
-                    text_info = line[1]  # (text, confidence)
-                    
-                    text = text_info[0]
-                    confidence = float(text_info[1])
-                    
-                    # Scale coordinates back from 2x
-                    x0 = box[0][0] / 2
-                    y0 = box[0][1] / 2
-                    x1 = box[2][0] / 2
-                    y1 = box[2][1] / 2
-                    
-                    # Infer field type
-                    field_type = infer_field_type_from_ocr(text, box)
-                    
-                    # Normalize coordinates
-                    normalized_rect = {
-                        "x": x0 / page_width,
-                        "y": y0 / page_height,
-                        "width": (x1 - x0) / page_width,
-                        "height": (y1 - y0) / page_height
-                    }
-                    
-                    absolute_rect = {
-                        "x0": x0,
-                        "y0": y0,
-                        "x1": x1,
-                        "y1": y1
-                    }
-                    
-                    field_region = {
-                        "id": f"ocr_{page_num}_{idx}",
-                        "page": page_num + 1,
-                        "type": field_type,
-                        "name": f"field_{page_num}_{idx}",
-                        "label": text,
-                        "value": "",
-                        "confidence": confidence,
-                        "rect_normalized": normalized_rect,
-                        "rect_absolute": absolute_rect,
-                        "source": "ocr"
-                    }
-                    
-                    field_regions.append(field_region)
+        # Scale coordinates back to PDF points and normalize them, for every
+        # box on the page at once: (N, 4, 2) corners -> rows of 4 values
+        boxes = np.asarray([line[0] for line in lines], dtype=np.float64) / scale
+        x0, y0 = boxes[:, 0, 0], boxes[:, 0, 1]
+        x1, y1 = boxes[:, 2, 0], boxes[:, 2, 1]
+        absolute_rects = np.stack([x0, y0, x1, y1], axis=1).tolist()
+        normalized_rects = np.stack([
+            x0 / page_width,
+            y0 / page_height,
+            (x1 - x0) / page_width,
+            (y1 - y0) / page_height
+        ], axis=1).tolist()
         
-        finally:
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        for idx, (line, (ax0, ay0, ax1, ay1), (nx, ny, nw, nh)) in enumerate(
+            zip(lines, absolute_rects, normalized_rects)
+        ):
+            box = line[0]  # [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]
+            text_info = line[1]  # (text, confidence)
+            
+            text = text_info[0]
+            confidence = float(text_info[1])
+            
+            # Infer field type
+            field_type = infer_field_type_from_ocr(text, box)
+            
+            # One literal per field; the nested rects are the documented wire format
+            field_regions.append({
+                "id": f"ocr_{page_num}_{idx}",
+                "page": page_num + 1,
+                "type": field_type,
+                "name": f"field_{page_num}_{idx}",
+                "label": text,
+                "value": "",
+                "confidence": confidence,
+                "rect_normalized": {"x": nx, "y": ny, "width": nw, "height": nh},
+                "rect_absolute": {"x0": ax0, "y0": ay0, "x1": ax1, "y1": ay1},
+                "source": "ocr"
+            })
     
     return field_regions
 
 
+class _LRUCache:
+    """
+    Least recently used cache, bounded by entry count and by the total size
+    of its entries (each put says how large its value is, in whatever unit
+    the cache is budgeted in). Not thread-safe: use each cache from one thread
+    """
+    
+    def __init__(self, max_entries: int, max_size: int):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self._entries: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        """Cached value for key (marking it recently used), or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+    
+    def put(self, key: Any, value: Any, size: int) -> None:
+        """Store a value, evicting the least recently used past either bound"""
+        if size > self.max_size:
+            # Would evict everything else and still not fit
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._entries[key] = (value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+# Content hash -> extraction result, sized by its field count. Only touched
+# from the event loop, so no lock. Cached results are shared between
+# responses and must not be mutated
+_RESULT_CACHE = _LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_MAX_FIELDS)
+
+
+def _content_hash() -> "hashlib.blake2b":
+    """Hasher for upload content; feed it chunks as they arrive"""
+    return hashlib.blake2b(digest_size=16)
+
+
+async def _read_upload(file: UploadFile, hasher, head: bytes = b"") -> bytes:
+    """
+    Read the rest of an upload in 1 MiB chunks, hashing each as it arrives
+    head: bytes already read from the upload, included at the front
+    """
+    hasher.update(head)
+    chunks = [head]
+    while True:
+        chunk = await file.read(1 << 20)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def _run_cached(key: Tuple[str, bytes], func, *args) -> Any:
+    """Run a blocking extraction on the executor, unless this content was seen recently"""
+    result = _RESULT_CACHE.get(key)
+    if result is None:
+        result = await asyncio.get_running_loop().run_in_executor(_EXECUTOR, func, *args)
+        # Field dicts dominate a result's memory, so they stand in for its size
+        _RESULT_CACHE.put(key, result, sum(len(part) for part in result if isinstance(part, list)))
+    return result
+
+
+def _process_pdf(contents: bytes, document_id: str) -> Tuple[bool, List[Dict[str, Any]], int]:
+    """
+    Blocking body of /process: AcroForm detection with OCR fallback
+    Returns: (has_acroform, field_regions, page_count)
+    """
+    # Open PDF with PyMuPDF straight from memory
+    doc = open_pdf(contents)
+    try:
+        page_count = len(doc)
+        
+        # Step 1: Try to detect AcroForm fields
+        has_acroform, field_regions = detect_acroform_fields(doc)
+        
+        # Step 2: Fallback to OCR if no AcroForm
+        if not has_acroform:
+            print(f"No AcroForm detected for {document_id}, falling back to OCR")
+            field_regions = detect_fields_via_ocr(doc)
+    finally:
+        doc.close()
+    
+    return has_acroform, field_regions, page_count
+
+
 @app.post("/process")
 async def process_document(request: Request, file: UploadFile = File(...)):
     """
     Hybrid worker endpoint: Detect AcroForm fields first, fallback to OCR
     Called by Cloud Tasks
     """
+    _check_upload_size(file)
+    
     document_id = str(uuid.uuid4())
     start_time = datetime.utcnow()
     
@@ -265,46 +449,29 @@ async def process_document(request: Request, file: UploadFile = File(...)):
         if not file.filename.lower().endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
         
-        # Read file
-        contents = await file.read()
+        # Read file, hashing it on the way in
+        hasher = _content_hash()
+        contents = await _read_upload(file, hasher)
         
-        # Save to temp file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
+        # Parse/OCR off the event loop; identical uploads (e.g. the same blank
+        # template) reuse the earlier result
+        has_acroform, field_regions, page_count = await _run_cached(
+            ("process", hasher.digest()), _process_pdf, contents, document_id
+        )
         
-        try:
-            # Open PDF with PyMuPDF
-            doc = fitz.open(tmp_path)
-            page_count = len(doc)
-            
-            # Step 1: Try to detect AcroForm fields
-            has_acroform, field_regions = detect_acroform_fields(doc)
-            
-            # Step 2: Fallback to OCR if no AcroForm
-            if not has_acroform:
-                print(f"No AcroForm detected for {document_id}, falling back to OCR")
-                field_regions = detect_fields_via_ocr(doc)
-            
-            doc.close()
-            
-            # Build response
-            response_data = {
-                "success": True,
-                "documentId": document_id,
-                "acroform": has_acroform,
-                "field_regions": field_regions,
-                "page_count": page_count,
-                "total_fields": len(field_regions),
-                "processing_time_ms": int((datetime.utcnow() - start_time).total_seconds() * 1000),
-                "timestamp": datetime.utcnow().isoformat()
-            }
-            
-            return JSONResponse(content=response_data)
+        # Build response
+        response_data = {
+            "success": True,
+            "documentId": document_id,
+            "acroform": has_acroform,
+            "field_regions": field_regions,
+            "page_count": page_count,
+            "total_fields": len(field_regions),
+            "processing_time_ms": int((datetime.utcnow() - start_time).total_seconds() * 1000),
+            "timestamp": datetime.utcnow().isoformat()
+        }
         
-        finally:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        return ORJSONResponse(content=response_data)
     
     except Exception as e:
         # Graceful error handling
@@ -317,99 +484,325 @@ async def process_document(request: Request, file: UploadFile = File(...)):
             "timestamp": datetime.utcnow().isoformat()
         }
         
-        return JSONResponse(content=error_response, status_code=500)
+        return ORJSONResponse(content=error_response, status_code=500)
 
 
-def pdf_to_images(pdf_path: str) -> List[Dict[str, Any]]:
-    """Convert PDF pages to images for OCR processing"""
-    doc = fitz.open(pdf_path)
-    images = []
+def open_pdf(pdf: Union[str, bytes]) -> fitz.Document:
+    """Open a PDF from a file path, or from bytes already in memory without touching disk"""
+    if isinstance(pdf, (bytes, bytearray)):
+        return fitz.open(stream=pdf, filetype="pdf")
+    return fitz.open(pdf)
+
+
+def _pixmap_to_array(pix: fitz.Pixmap, buffer: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Copy a pixmap's raw samples into an HxWxN uint8 array (no PNG encode/decode)
+    If a large enough flat uint8 buffer is given, the pixels are written into it
+    instead of a fresh allocation
+    """
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.alpha:
+        samples = samples[..., :-1]
+    if samples.shape[2] == 1:
+        # Grayscale goes through as HxW; PaddleOCR expands it to 3 channels itself
+        samples = samples[..., 0]
+    else:
+        # PaddleOCR treats arrays as OpenCV images, i.e. BGR; flip while copying
+        samples = samples[..., ::-1]
     
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        # Render at 2x resolution for better OCR
-        mat = fitz.Matrix(2, 2)
-        pix = page.get_pixmap(matrix=mat)
-        
-        # Convert to PIL Image
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Save to temp file
-        temp_img = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-        img.save(temp_img.name, 'PNG')
+    if buffer is None or buffer.nbytes < samples.nbytes:
+        # Always copy: the samples view is read-only and dies with the pixmap
+        return samples.copy()
+    
+    out = buffer[:samples.nbytes].reshape(samples.shape)
+    np.copyto(out, samples)
+    return out
+
+
+def render_scale(page: fitz.Page) -> float:
+    """
+    Render scale for OCR: OCR_RENDER_SCALE, capped so the longest edge stays
+    within MAX_RENDER_EDGE px (OCR latency grows with pixel count)
+    """
+    return min(OCR_RENDER_SCALE, MAX_RENDER_EDGE / max(page.rect.width, page.rect.height))
+
+
+def _render_page(page: fitz.Page, page_num: int, buffer: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """Render a single page to an in-memory grayscale array and return its image metadata"""
+    scale = render_scale(page)
+    # OCR only needs luminance; a 1-channel render is a third of the bytes of RGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    image = _pixmap_to_array(pix, buffer)
+    # The pixels have been copied out; release the pixmap's buffer right away
+    pix = None
+    
+    return {
+        "page": page_num + 1,
+        "image": image,
+        "width": page.rect.width,
+        "height": page.rect.height,
+        "dpi_scale": scale
+    }
+
+
+def render_pages(doc: fitz.Document, page_nums: Optional[Iterable[int]] = None,
+                 buffers: Optional[List[Optional[np.ndarray]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Render pages of an open document (all of them, or page_nums) for OCR
+    The one renderer behind every endpoint. Given a ring of buffers, page i is
+    rendered into buffers[i % len(buffers)], growing the slot if the page
+    doesn't fit, so its image is only valid until the ring wraps around
+    """
+    if page_nums is None:
+        page_nums = range(len(doc))
+    
+    for i, page_num in enumerate(page_nums):
+        if buffers is None:
+            yield _render_page(doc[page_num], page_num)
+            continue
         
-        images.append({
-            "page": page_num + 1,
-            "path": temp_img.name,
-            "width": page.rect.width,
-            "height": page.rect.height,
-            "dpi_scale": 2.0
-        })
+        slot = i % len(buffers)
+        img_data = _render_page(doc[page_num], page_num, buffers[slot])
+        if buffers[slot] is None or not np.may_share_memory(img_data["image"], buffers[slot]):
+            # Didn't fit: keep the larger array as this slot's buffer
+            buffers[slot] = img_data["image"].reshape(-1)
+        yield img_data
+
+
+def pipelined_pages(doc: fitz.Document) -> Iterator[Dict[str, Any]]:
+    """
+    Yield rendered pages of an open document, rasterizing ahead of the caller
+    A background thread renders page N+1 while the caller OCRs page N; the
+    bounded queue keeps rendering at most a couple of pages ahead. The caller
+    must not touch the document until the generator is exhausted or closed
+    (PyMuPDF documents are not thread-safe). A yielded image is only valid
+    until the next page is requested
+    """
+    q: queue.Queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    
+    # Reusable page buffers, one per page that can be alive at once: those in
+    # the queue, the one being OCR'd and the one being rendered. Pages of a
+    # document are usually the same size, so each is allocated once
+    buffers: List[Optional[np.ndarray]] = [None] * (q.maxsize + 2)
+    
+    def render_producer():
+        try:
+            for img_data in render_pages(doc, buffers=buffers):
+                if stop.is_set():
+                    return
+                q.put(img_data)
+        except Exception as e:
+            # Hand render errors to the consumer so the request fails instead of hanging
+            q.put(e)
+        finally:
+            q.put(None)  # Sentinel: no more pages
+    
+    producer = threading.Thread(target=render_producer, daemon=True)
+    producer.start()
+    
+    try:
+        while True:
+            img_data = q.get()
+            if img_data is None:
+                break
+            if isinstance(img_data, Exception):
+                raise img_data
+            yield img_data
+    finally:
+        # If the caller stopped early, unblock the producer so its thread can exit
+        stop.set()
+        while producer.is_alive():
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                producer.join(0.05)
+
+
+def pipelined_process(pdf: Union[str, bytes]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Render and OCR a PDF (file path or raw bytes), overlapping the two stages
+    Returns: (all_fields, page_metadata)
+    """
+    all_fields = []
+    page_metadata = []
+    
+    doc = open_pdf(pdf)
+    try:
+        for img_data in pipelined_pages(doc):
+            page_fields = process_ocr_on_image(
+                img_data["image"],
+                img_data["page"],
+                img_data["width"],
+                img_data["height"],
+                img_data["dpi_scale"]
+            )
+            all_fields.extend(page_fields)
+            
+            page_metadata.append({
+                "page": img_data["page"],
+                "width": img_data["width"],
+                "height": img_data["height"]
+            })
+    finally:
+        doc.close()
+    
+    return all_fields, page_metadata
+
+
+# Checkbox patterns: an anchored symbol prefix plus a fixed set of option
+# words the text ends with; neither needs to scan the whole line
+_CHECKBOX_PREFIX_RE = re.compile(r'\s*[\[\]☐☑✓✗xX○●]')  # Checkbox or radio button symbol
+_CHECKBOX_SUFFIXES = ('new', 'additional', 'damaged', 'lost', 'yes', 'no', 'male', 'female', 'mr', 'ms', 'mrs')
+
+# Every classifier keyword list, by category. All of them are matched in one
+# Aho-Corasick pass per OCR line instead of one substring scan per keyword
+_KEYWORD_CATEGORIES = {
+    # classify_field_type
+    "table": ('no.', 'date', 'name', 'nric', 'contact', 'address'),
+    "text_field": ('name', 'nric', 'contact', 'address', 'email', 'phone', 'date of birth', 'occupation'),
+    "title": ('application', 'form', 'details', 'information', 'section'),
+    # detect_component_type
+    "button": ('submit', 'login', 'sign in', 'sign up', 'register', 'continue', 'next', 'back', 'cancel', 'ok', 'confirm', 'save', 'delete', 'add', 'create'),
+    "primary_button": ('submit', 'login', 'continue', 'confirm'),
+    "input": ('email', 'password', 'username', 'name', 'phone', 'address'),
+    "email": ('email',),
+    "password": ('password',),
+    "checkbox": ('agree', 'accept', 'remember', 'terms', 'conditions'),
+    "link": ('forgot', 'click here', 'learn more', 'terms', 'privacy'),
+}
+
+
+def _build_keyword_automaton(categories: Dict[str, Tuple[str, ...]]) -> ahocorasick.Automaton:
+    """Build one automaton mapping each keyword to every category it belongs to"""
+    keyword_categories: Dict[str, set] = {}
+    for category, keywords in categories.items():
+        for keyword in keywords:
+            keyword_categories.setdefault(keyword, set()).add(category)
     
-    doc.close()
-    return images
+    automaton = ahocorasick.Automaton()
+    for keyword, cats in keyword_categories.items():
+        automaton.add_word(keyword, frozenset(cats))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton(_KEYWORD_CATEGORIES)
 
 
-def classify_field_type(text: str, bbox: List, nearby_texts: List[str] = None) -> str:
+@functools.lru_cache(maxsize=4096)
+def _match_keyword_categories(text_lower: str) -> frozenset:
+    """
+    Return every keyword category occurring (as a substring) in the text, in one linear scan
+    Cached so the field and component classifiers share one scan per text
+    """
+    matched = set()
+    for _, cats in _KEYWORD_AUTOMATON.iter(text_lower):
+        matched |= cats
+    return frozenset(matched)
+
+
+@dataclass(slots=True)
+class FieldFeatures:
+    """Text and geometry of one OCR line, computed once and shared by the classifiers"""
+    text: str
+    text_lower: str
+    length: int
+    is_upper: bool
+    ends_with_colon: bool
+    height: float = 0.0
+    width: float = 0.0
+    y_position: float = 0.0  # Normalized (0-1) from the top of the page
+
+
+def extract_features(text: str, box: Optional[List] = None, y_position: float = 0.0) -> FieldFeatures:
+    """Build FieldFeatures from OCR text and its box [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]"""
+    return FieldFeatures(
+        text=text,
+        text_lower=text.lower().strip(),
+        length=len(text),
+        is_upper=text.isupper(),
+        ends_with_colon=text.endswith(':'),
+        height=abs(box[2][1] - box[0][1]) if box else 0.0,
+        width=abs(box[1][0] - box[0][0]) if box else 0.0,
+        y_position=y_position
+    )
+
+
+def classify_field_type(features: FieldFeatures) -> str:
     """
     Classify field type based on text content and context
     Returns: checkbox, text_field, table_cell, title, label, non_fillable
     """
-    text_lower = text.lower().strip()
-    
+    # Only the text decides the type, and forms repeat labels across pages
+    return _classify_text(features.text_lower, features.length, features.ends_with_colon, features.is_upper)
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_text(text_lower: str, text_len: int, ends_with_colon: bool, is_upper: bool) -> str:
+    """
+    Cached body of classify_field_type
+    Rules apply in priority order, with the cheap tests run before the keyword scan
+    """
     # Checkbox patterns
-    checkbox_patterns = [
-        r'^\s*[\[\]☐☑✓✗xX]\s*',  # Starts with checkbox symbol
-        r'(new|additional|damaged|lost|yes|no|male|female|mr|ms|mrs)$',
-        r'^\s*[○●]\s*'  # Radio button
-    ]
-    for pattern in checkbox_patterns:
-        if re.search(pattern, text_lower):
-            return "checkbox"
+    if _CHECKBOX_PREFIX_RE.match(text_lower) or text_lower.endswith(_CHECKBOX_SUFFIXES):
+        return "checkbox"
+    
+    # Too long for a table cell, so a trailing colon decides without scanning
+    if text_len >= 50 and ends_with_colon:
+        return "text_field"
+    
+    matched = _match_keyword_categories(text_lower)
     
     # Table cell detection (short text, structured)
-    if len(text) < 50 and any(keyword in text_lower for keyword in ['no.', 'date', 'name', 'nric', 'contact', 'address']):
+    if text_len < 50 and "table" in matched:
         return "table_cell"
     
     # Text field labels (ends with colon or common field names)
-    if text.endswith(':') or any(keyword in text_lower for keyword in [
-        'name', 'nric', 'contact', 'address', 'email', 'phone', 'date of birth', 'occupation'
-    ]):
+    if ends_with_colon or "text_field" in matched:
         return "text_field"
     
     # Title detection (short, uppercase, or large font implied by position)
-    if len(text) < 60 and (text.isupper() or any(keyword in text_lower for keyword in [
-        'application', 'form', 'details', 'information', 'section'
-    ])):
+    if text_len < 60 and (is_upper or "title" in matched):
         return "title"
     
     # Label-only text
-    if len(text) < 30:
-        return "label"
-    
-    return "non_fillable"
+    return "label" if text_len < 30 else "non_fillable"
 
 
-def detect_component_type(text: str, box: List, y_position: float) -> Dict[str, Any]:
+def detect_component_type(features: FieldFeatures) -> Dict[str, Any]:
     """
     Analyze text and position to determine UI component type
     """
-    text_lower = text.lower().strip()
-    height = abs(box[2][1] - box[0][1])
-    width = abs(box[1][0] - box[0][0])
+    height = features.height
+    
+    # Reduce the geometry to the thresholds the rules test, so repeated
+    # texts hit the cache regardless of their exact box
+    component = _detect_component_cached(
+        features.text, features.text_lower, features.length, features.ends_with_colon,
+        height < 50, height > 30, height > 40, features.y_position < 0.2
+    )
+    
+    # Cached dicts are shared; hand the caller its own copy
+    return dict(component)
+
+
+@functools.lru_cache(maxsize=4096)
+def _detect_component_cached(text: str, text_lower: str, text_len: int, ends_with_colon: bool,
+                             under_50: bool, over_30: bool, over_40: bool, near_top: bool) -> Dict[str, Any]:
+    """Cached body of detect_component_type"""
+    matched = _match_keyword_categories(text_lower)
     
     # Detect buttons (common button text patterns)
-    button_keywords = ['submit', 'login', 'sign in', 'sign up', 'register', 'continue', 'next', 'back', 'cancel', 'ok', 'confirm', 'save', 'delete', 'add', 'create']
-    if any(keyword in text_lower for keyword in button_keywords) or (len(text) < 20 and height < 50):
+    if "button" in matched or (text_len < 20 and under_50):
         return {
             "type": "button",
-            "variant": "primary" if any(k in text_lower for k in ['submit', 'login', 'continue', 'confirm']) else "secondary"
+            "variant": "primary" if "primary_button" in matched else "secondary"
         }
     
     # Detect input fields (labels ending with :)
-    if text.endswith(':') or any(keyword in text_lower for keyword in ['email', 'password', 'username', 'name', 'phone', 'address']):
-        input_type = "email" if 'email' in text_lower else "password" if 'password' in text_lower else "text"
+    if ends_with_colon or "input" in matched:
+        input_type = "email" if "email" in matched else "password" if "password" in matched else "text"
         return {
             "type": "input",
             "inputType": input_type,
@@ -417,15 +810,15 @@ def detect_component_type(text: str, box: List, y_position: float) -> Dict[str,
         }
     
     # Detect headings (larger text, typically at top)
-    if y_position < 0.2 and (height > 30 or len(text) < 50):
-        return {"type": "heading", "level": 1 if height > 40 else 2}
+    if near_top and (over_30 or text_len < 50):
+        return {"type": "heading", "level": 1 if over_40 else 2}
     
     # Detect checkboxes/radio (short text with specific patterns)
-    if len(text) < 30 and any(keyword in text_lower for keyword in ['agree', 'accept', 'remember', 'terms', 'conditions']):
+    if text_len < 30 and "checkbox" in matched:
         return {"type": "checkbox"}
     
     # Detect links
-    if any(keyword in text_lower for keyword in ['forgot', 'click here', 'learn more', 'terms', 'privacy']):
+    if "link" in matched:
         return {"type": "link"}
     
     # Default to text
@@ -443,18 +836,39 @@ def generate_ui_schema(fields: List[Dict]) -> Dict[str, Any]:
     # Group fields by page and vertical proximity
     sections = []
     current_section = None
-    last_y = 0
-    section_threshold = 100  # pixels
+    section_threshold = 50  # PDF points (bboxes are compared after dividing out dpi_scale)
     
-    # Sort by page and y-position
-    sorted_fields = sorted(fields, key=lambda f: (f["page"], f["bbox"][1]))
+    # Bucket by page instead of sorting: PaddleOCR already returns each page's
+    # lines top to bottom, so arrival order within a page is kept as-is
+    pages_fields: Dict[int, List[Dict]] = {}
+    for field in fields:
+        pages_fields.setdefault(field["page"], []).append(field)
     
-    for field in sorted_fields:
-        y_pos = field["bbox"][1]
-        
+    # Gap breaks: a large vertical jump from the previous field, or a new page
+    ordered = []  # (field, is_gap)
+    for page in sorted(pages_fields):
+        prev_y = None
+        for field in pages_fields[page]:
+            y = field["bbox"][1] / field["dpi_scale"]
+            ordered.append((field, prev_y is None or abs(y - prev_y) > section_threshold))
+            prev_y = y
+    
+    # Run of consecutive checkboxes in the current section, folded into a
+    # dropdown as soon as the run ends
+    checkbox_group = []
+    
+    def flush_checkboxes():
+        if checkbox_group:
+            current_section["fields"].extend(
+                group_checkboxes_to_dropdowns(checkbox_group, current_section["section"])
+            )
+            checkbox_group.clear()
+    
+    for field, is_gap in ordered:
         # Detect section breaks (titles or large gaps)
-        if field["type"] == "title" or (current_section and abs(y_pos - last_y) > section_threshold):
+        if field["type"] == "title" or (current_section and is_gap):
             if current_section:
+                flush_checkboxes()
                 sections.append(current_section)
             
             current_section = {
@@ -472,22 +886,22 @@ def generate_ui_schema(fields: List[Dict]) -> Dict[str, Any]:
         
         # Skip titles from fields list
         if field["type"] == "title":
-            last_y = y_pos
             continue
         
         # Convert field to UI component
         ui_field = convert_field_to_ui(field)
         if ui_field:
-            current_section["fields"].append(ui_field)
-        
-        last_y = y_pos
+            if ui_field["type"] == "checkbox":
+                checkbox_group.append(ui_field)
+            else:
+                flush_checkboxes()
+                current_section["fields"].append(ui_field)
     
     # Add last section
-    if current_section and current_section["fields"]:
-        sections.append(current_section)
-    
-    # Group checkboxes into dropdowns
-    sections = group_checkboxes_to_dropdowns(sections)
+    if current_section:
+        flush_checkboxes()
+        if current_section["fields"]:
+            sections.append(current_section)
     
     return {"form_schema": sections}
 
@@ -505,11 +919,12 @@ def convert_field_to_ui(field: Dict) -> Optional[Dict]:
         }
     
     elif field_type == "text_field":
+        title = field["label"].rstrip(':')
         return {
             "id": field["id"],
             "type": "text_field",
-            "title": field["label"].rstrip(':'),
-            "placeholder": f"Enter {field['label'].rstrip(':').lower()}"
+            "title": title,
+            "placeholder": f"Enter {title.lower()}"
         }
     
     elif field_type == "table_cell":
@@ -528,61 +943,44 @@ def convert_field_to_ui(field: Dict) -> Optional[Dict]:
     return None
 
 
-def group_checkboxes_to_dropdowns(sections: List[Dict]) -> List[Dict]:
+def group_checkboxes_to_dropdowns(checkbox_group: List[Dict], section_title: str) -> List[Dict]:
     """
-    Convert groups of checkboxes into dropdown components
+    Convert a run of consecutive checkboxes into a dropdown component
+    A lone checkbox stays a checkbox
     """
-    for section in sections:
-        fields = section["fields"]
-        grouped_fields = []
-        checkbox_group = []
-        
-        for field in fields:
-            if field["type"] == "checkbox":
-                checkbox_group.append(field)
-            else:
-                # Flush checkbox group if we have multiple
-                if len(checkbox_group) > 1:
-                    grouped_fields.append({
-                        "id": f"dropdown_{checkbox_group[0]['id']}",
-                        "type": "dropdown",
-                        "title": section["section"],
-                        "options": [cb["title"] for cb in checkbox_group]
-                    })
-                    checkbox_group = []
-                elif len(checkbox_group) == 1:
-                    grouped_fields.append(checkbox_group[0])
-                    checkbox_group = []
-                
-                grouped_fields.append(field)
-        
-        # Flush remaining checkboxes
-        if len(checkbox_group) > 1:
-            grouped_fields.append({
-                "id": f"dropdown_{checkbox_group[0]['id']}",
-                "type": "dropdown",
-                "title": section["section"],
-                "options": [cb["title"] for cb in checkbox_group]
-            })
-        elif len(checkbox_group) == 1:
-            grouped_fields.append(checkbox_group[0])
-        
-        section["fields"] = grouped_fields
+    if len(checkbox_group) == 1:
+        return [checkbox_group[0]]
     
-    return sections
+    return [{
+        "id": f"dropdown_{checkbox_group[0]['id']}",
+        "type": "dropdown",
+        "title": section_title,
+        "options": [cb["title"] for cb in checkbox_group]
+    }]
 
 
-def process_ocr_on_image(image_path: str, page_num: int = 1, page_width: float = 0, page_height: float = 0) -> List[Dict]:
-    """Process OCR on a single image and return structured field data"""
-    result = ocr.ocr(image_path, cls=True)
+def process_ocr_on_image(image: Union[str, bytes, np.ndarray], page_num: int = 1, page_width: float = 0, page_height: float = 0, dpi_scale: float = 1.0) -> List[Dict]:
+    """
+    Process OCR on a single image and return structured field data
+    Accepts an image file path, encoded image bytes or an HxWxC uint8 BGR array
+    (PaddleOCR takes any of them)
+    dpi_scale: image pixels per PDF point, recorded so bboxes can be mapped back
+    """
+    # PaddleOCR 2.x only accepts one image per call when detection is enabled
+    result = ocr.ocr(image, cls=True)
     
-    if not result or not result[0]:
+    return _parse_page(result[0] if result else None, page_num, page_width, page_height, dpi_scale)
+
+
+def _parse_page(page_result: Optional[List], page_num: int, page_width: float, page_height: float, dpi_scale: float) -> List[Dict]:
+    """Turn one page of PaddleOCR output ([box, (text, confidence)] lines) into field data"""
+    if not page_result:
         return []
     
     fields = []
     field_counter = 1
     
-    for line in result[0]:
+    for line in page_result:
         box = line[0]  # [[x1,y1], [x2,y2], [x3,y3], [x4,y4]]
         text_info = line[1]  # (text, confidence)
         
@@ -592,8 +990,9 @@ def process_ocr_on_image(image_path: str, page_num: int = 1, page_width: float =
         # Convert box to flat format [x1,y1,x2,y2,x3,y3,x4,y4]
         bbox = [coord for point in box for coord in point]
         
-        # Classify field type
-        field_type = classify_field_type(text, bbox)
+        # Classify field type from features computed once per line
+        y_position = box[0][1] / (page_height * dpi_scale) if page_height else 0.0
+        field_type = classify_field_type(extract_features(text, box, y_position))
         
         field_id = f"field_{page_num:03d}_{field_counter:03d}"
         
@@ -604,7 +1003,8 @@ def process_ocr_on_image(image_path: str, page_num: int = 1, page_width: float =
             "bbox": bbox,
             "page": page_num,
             "confidence": confidence,
-            "value": False if field_type == "checkbox" else ""
+            "value": False if field_type == "checkbox" else "",
+            "dpi_scale": dpi_scale
         }
         
         # Add table cell metadata if applicable
@@ -621,7 +1021,8 @@ def process_ocr_on_image(image_path: str, page_num: int = 1, page_width: float =
 def flatten_ui_schema_to_components(all_fields: List[Dict]) -> List[Dict]:
     """
     Convert OCR fields to flat components array for React Native
-    Returns: [{ id, type, label, value, bbox, page }, ...]
+    Returns: [{ id, type, label, value, bbox, page, dpi_scale }, ...]
+    bbox is in rendered pixels; divide by dpi_scale for PDF points
     """
     components = []
     
@@ -636,7 +1037,8 @@ def flatten_ui_schema_to_components(all_fields: List[Dict]) -> List[Dict]:
             "id": field["id"],
             "label": field["label"],
             "bbox": field["bbox"],
-            "page": field["page"]
+            "page": field["page"],
+            "dpi_scale": field["dpi_scale"]
         }
         
         # Map field types to component types
@@ -659,7 +1061,7 @@ def flatten_ui_schema_to_components(all_fields: List[Dict]) -> List[Dict]:
 
 def create_field_map(all_fields: List[Dict]) -> Dict[str, Dict]:
     """
-    Create fieldMap for overlay: { field_id: { bbox, page } }
+    Create fieldMap for overlay: { field_id: { bbox, page, type, dpi_scale } }
     """
     field_map = {}
     
@@ -668,12 +1070,115 @@ def create_field_map(all_fields: List[Dict]) -> Dict[str, Dict]:
             field_map[field["id"]] = {
                 "bbox": field["bbox"],
                 "page": field["page"],
-                "type": field["type"]
+                "type": field["type"],
+                "dpi_scale": field["dpi_scale"]
             }
     
     return field_map
 
 
+# Leading magic bytes -> upload kind; enough to tell a PDF from the image
+# formats PaddleOCR can decode, without a libmagic scan
+_MAGIC_KINDS = (
+    (b'%PDF', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image'),
+    (b'\xff\xd8\xff', 'image'),  # JPEG
+    (b'BM', 'image'),
+    (b'II*\x00', 'image'),  # TIFF, little-endian
+    (b'MM\x00*', 'image'),  # TIFF, big-endian
+)
+
+# Pillow formats tried when reading an uploaded image's size (skips probing the rest)
+_IMAGE_FORMATS = ('PNG', 'JPEG', 'BMP', 'TIFF')
+
+# File extension -> upload kind, for content the magic bytes don't identify
+_EXT_KINDS = {
+    '.pdf': 'pdf',
+    '.jpg': 'image',
+    '.jpeg': 'image',
+    '.png': 'image',
+    '.bmp': 'image',
+    '.tiff': 'image',
+}
+
+
+def _detect_kind(header: bytes, filename: Optional[str]) -> Optional[str]:
+    """Upload kind ('pdf' or 'image') from its first bytes, falling back to the filename"""
+    for signature, kind in _MAGIC_KINDS:
+        if header.startswith(signature):
+            return kind
+    return _EXT_KINDS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def _extract_image_fields(contents: bytes) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Blocking OCR of a single uploaded image, straight from its encoded bytes
+    Returns: (all_fields, page_metadata)
+    """
+    # PIL only parses the header for the size; PaddleOCR decodes the pixels itself
+    with Image.open(io.BytesIO(contents), formats=_IMAGE_FORMATS) as img:
+        width, height = img.size
+    
+    page_fields = process_ocr_on_image(contents, 1, width, height)
+    return page_fields, [{"page": 1, "width": width, "height": height}]
+
+
+def _spool(src, dst, hasher) -> None:
+    """Copy an upload to disk in 1 MiB chunks, hashing them on the way"""
+    while True:
+        chunk = src.read(1 << 20)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        dst.write(chunk)
+
+
+async def _extract_fields(file: UploadFile) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Shared body of /ocr and /ui/generate: sniff the upload, OCR every page
+    Returns: (all_fields, page_metadata)
+    """
+    # Only the header is needed to sniff the type
+    header = await file.read(4096)
+    
+    # Detect actual file type from content (magic bytes), falling back to the filename
+    kind = _detect_kind(header, file.filename)
+    
+    # Results are cached by content hash, so repeat uploads skip OCR
+    hasher = _content_hash()
+    
+    # Handle images: OCR from memory, no temp file round-trip
+    if kind == 'image':
+        contents = await _read_upload(file, hasher, header)
+        return await _run_cached(("fields", hasher.digest()), _extract_image_fields, contents)
+    
+    if kind != 'pdf':
+        raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF or image files.")
+    
+    # Handle PDF: open small uploads straight from memory
+    body = await file.read(PDF_IN_MEMORY_MAX)
+    if len(body) < PDF_IN_MEMORY_MAX:
+        contents = header + body
+        hasher.update(contents)
+        return await _run_cached(("fields", hasher.digest()), pipelined_process, contents)
+    
+    # Large PDFs are spooled to disk instead, where MuPDF reads them lazily
+    with contextlib.ExitStack() as cleanup:
+        # All of this request's temp files live in one directory, removed on success or error
+        tmp_dir = cleanup.enter_context(tempfile.TemporaryDirectory())
+        tmp_path = os.path.join(tmp_dir, "upload.pdf")
+        
+        # Stream the rest of the upload in chunks; it is never held in RAM as one bytes object
+        with open(tmp_path, 'wb') as tmp:
+            for chunk in (header, body):
+                hasher.update(chunk)
+                tmp.write(chunk)
+            del body, chunk
+            await run_in_threadpool(_spool, file.file, tmp, hasher)
+        
+        return await _run_cached(("fields", hasher.digest()), pipelined_process, tmp_path)
+
+
 @app.post("/ocr")
 async def ocr_endpoint(file: UploadFile = File(...)):
     """
@@ -683,100 +1188,31 @@ async def ocr_endpoint(file: UploadFile = File(...)):
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
     
+    _check_upload_size(file)
+    
     try:
-        contents = await file.read()
-        
-        # Detect actual file type from content (magic bytes)
-        mime = magic.from_buffer(contents, mime=True)
+        all_fields, page_metadata = await _extract_fields(file)
         
-        # Determine correct extension based on actual content
-        if mime == 'application/pdf':
-            file_ext = '.pdf'
-        elif mime in ['image/jpeg', 'image/jpg']:
-            file_ext = '.jpg'
-        elif mime == 'image/png':
-            file_ext = '.png'
-        elif mime in ['image/bmp', 'image/x-ms-bmp']:
-            file_ext = '.bmp'
-        elif mime in ['image/tiff', 'image/x-tiff']:
-            file_ext = '.tiff'
-        else:
-            # Fallback to filename extension
-            file_ext = os.path.splitext(file.filename)[1].lower()
-        
-        # Save uploaded file with correct extension
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
+        # Generate UI schema
+        ui_schema = generate_ui_schema(all_fields)
         
-        all_fields = []
-        page_metadata = []
+        # Tally field types in one pass
+        type_counts = Counter(f["type"] for f in all_fields)
         
-        try:
-            # Handle PDF
-            if file_ext == '.pdf':
-                images = pdf_to_images(tmp_path)
-                
-                for img_data in images:
-                    page_fields = process_ocr_on_image(
-                        img_data["path"], 
-                        img_data["page"],
-                        img_data["width"],
-                        img_data["height"]
-                    )
-                    all_fields.extend(page_fields)
-                    
-                    page_metadata.append({
-                        "page": img_data["page"],
-                        "width": img_data["width"],
-                        "height": img_data["height"]
-                    })
-                    
-                    # Cleanup temp image
-                    os.unlink(img_data["path"])
-            
-            # Handle images
-            elif file_ext in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']:
-                # Get image dimensions
-                img = Image.open(tmp_path)
-                width, height = img.size
-                
-                page_fields = process_ocr_on_image(tmp_path, 1, width, height)
-                all_fields.extend(page_fields)
-                
-                page_metadata.append({
-                    "page": 1,
-                    "width": width,
-                    "height": height
-                })
-            else:
-                raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF or image files.")
-            
-            # Generate UI schema
-            ui_schema = generate_ui_schema(all_fields)
-            
-            return JSONResponse(content={
-                "success": True,
-                "ui_schema": ui_schema,
-                "ocr_blocks": all_fields,
-                "pdf_metadata": {
-                    "pages": page_metadata,
-                    "total_pages": len(page_metadata),
-                    "total_fields": len(all_fields)
-                },
-                "field_types": {
-                    "checkbox": len([f for f in all_fields if f["type"] == "checkbox"]),
-                    "text_field": len([f for f in all_fields if f["type"] == "text_field"]),
-                    "table_cell": len([f for f in all_fields if f["type"] == "table_cell"]),
-                    "title": len([f for f in all_fields if f["type"] == "title"]),
-                    "label": len([f for f in all_fields if f["type"] == "label"]),
-                    "non_fillable": len([f for f in all_fields if f["type"] == "non_fillable"])
-                }
-            })
-        
-        finally:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        return ORJSONResponse(content={
+            "success": True,
+            "ui_schema": ui_schema,
+            "ocr_blocks": all_fields,
+            "pdf_metadata": {
+                "pages": page_metadata,
+                "total_pages": len(page_metadata),
+                "total_fields": len(all_fields)
+            },
+            "field_types": {
+                field_type: type_counts.get(field_type, 0)
+                for field_type in ("checkbox", "text_field", "table_cell", "title", "label", "non_fillable")
+            }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
@@ -791,100 +1227,40 @@ async def ui_generate_endpoint(file: UploadFile = File(...)):
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
     
+    _check_upload_size(file)
+    
     try:
-        contents = await file.read()
-        
-        # Detect actual file type from content (magic bytes)
-        mime = magic.from_buffer(contents, mime=True)
-        
-        # Determine correct extension based on actual content
-        if mime == 'application/pdf':
-            file_ext = '.pdf'
-        elif mime in ['image/jpeg', 'image/jpg']:
-            file_ext = '.jpg'
-        elif mime == 'image/png':
-            file_ext = '.png'
-        elif mime in ['image/bmp', 'image/x-ms-bmp']:
-            file_ext = '.bmp'
-        elif mime in ['image/tiff', 'image/x-tiff']:
-            file_ext = '.tiff'
-        else:
-            # Fallback to filename extension
-            file_ext = os.path.splitext(file.filename)[1].lower()
+        all_fields, page_metadata = await _extract_fields(file)
         
-        # Save uploaded file with correct extension
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
+        # Convert to flat components array
+        components = flatten_ui_schema_to_components(all_fields)
         
-        all_fields = []
-        page_metadata = []
+        # Create field map for overlay
+        field_map = create_field_map(all_fields)
         
-        try:
-            # Handle PDF
-            if file_ext == '.pdf':
-                images = pdf_to_images(tmp_path)
-                
-                for img_data in images:
-                    page_fields = process_ocr_on_image(
-                        img_data["path"], 
-                        img_data["page"],
-                        img_data["width"],
-                        img_data["height"]
-                    )
-                    all_fields.extend(page_fields)
-                    
-                    page_metadata.append({
-                        "page": img_data["page"],
-                        "width": img_data["width"],
-                        "height": img_data["height"]
-                    })
-                    
-                    # Cleanup temp image
-                    os.unlink(img_data["path"])
-            
-            # Handle images
-            elif file_ext in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']:
-                # Get image dimensions
-                img = Image.open(tmp_path)
-                width, height = img.size
-                
-                page_fields = process_ocr_on_image(tmp_path, 1, width, height)
-                all_fields.extend(page_fields)
-                
-                page_metadata.append({
-                    "page": 1,
-                    "width": width,
-                    "height": height
-                })
-            else:
-                raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF or image files.")
-            
-            # Convert to flat components array
-            components = flatten_ui_schema_to_components(all_fields)
-            
-            # Create field map for overlay
-            field_map = create_field_map(all_fields)
-            
-            return JSONResponse(content={
-                "success": True,
-                "components": components,
-                "fieldMap": field_map,
-                "metadata": {
-                    "pages": page_metadata,
-                    "total_pages": len(page_metadata),
-                    "total_fields": len(components)
-                }
-            })
-        
-        finally:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        return ORJSONResponse(content={
+            "success": True,
+            "components": components,
+            "fieldMap": field_map,
+            "metadata": {
+                "pages": page_metadata,
+                "total_pages": len(page_metadata),
+                "total_fields": len(components)
+            }
+        })
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
 
 
+def _content_disposition(filename: str) -> str:
+    """Attachment header for a download, RFC 5987-encoded when the name isn't plain ASCII"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
 @app.post("/overlay")
 async def overlay_pdf(
     file: UploadFile = File(...),
@@ -902,144 +1278,135 @@ async def overlay_pdf(
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
     
+    _check_upload_size(file)
+    
     try:
-        # Parse filled data
+        # Parse filled data (large forms send MB-sized payloads; orjson parses them several times faster)
         try:
-            data = json.loads(filled_data)
-        except json.JSONDecodeError:
+            data = orjson.loads(filled_data)
+        except orjson.JSONDecodeError:
             raise HTTPException(status_code=400, detail="Invalid JSON in filled_data")
         
-        # Read PDF
-        contents = await file.read()
+        # The upload is hashed as it is read, to recognise templates overlaid before
+        hasher = _content_hash()
+        loop = asyncio.get_running_loop()
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_in:
-            tmp_in.write(contents)
-            tmp_in_path = tmp_in.name
-        
-        # Create output PDF
-        output_path = tempfile.mktemp(suffix='_filled.pdf')
-        
-        try:
-            # Open PDF with PyMuPDF
-            doc = fitz.open(tmp_in_path)
-            
-            # Get values and fieldMap
-            values = data.get("values", {})
-            field_map = data.get("fieldMap", {})
-            
-            print(f"DEBUG: Processing {len(values)} values")
-            print(f"DEBUG: Field map has {len(field_map)} fields")
-            print(f"DEBUG: Values: {values}")
-            
-            # Process each field
-            for field_id, value in values.items():
-                # Skip only if value is None or empty string, but allow False for checkboxes
-                if (value is None or value == "") and value is not False:
-                    continue
-                    
-                if field_id not in field_map:
-                    print(f"DEBUG: Field {field_id} not in field_map")
-                    continue
-                
-                print(f"DEBUG: Processing field {field_id} with value {value}")
-                
-                field_info = field_map[field_id]
-                page_num = field_info.get("page", 1) - 1  # 0-indexed
-                
-                if page_num >= len(doc):
-                    print(f"DEBUG: Page {page_num} out of range")
-                    continue
-                
-                page = doc[page_num]
-                bbox = field_info.get("bbox", [])
-                field_type = field_info.get("type", "text_field")
-                
-                if len(bbox) != 8:
-                    print(f"DEBUG: Invalid bbox length: {len(bbox)}")
-                    continue
-                
-                # OCR was done at 2x scale, so divide coordinates by 2
-                # Convert bbox [x1,y1,x2,y2,x3,y3,x4,y4] to rect
-                x1, y1 = min(bbox[0], bbox[6]) / 2, min(bbox[1], bbox[3]) / 2
-                x2, y2 = max(bbox[2], bbox[4]) / 2, max(bbox[5], bbox[7]) / 2
-                rect = fitz.Rect(x1, y1, x2, y2)
-                
-                print(f"DEBUG: Drawing at rect {rect} on page {page_num}")
-                
-                # Handle different field types
-                if field_type == "checkbox":
-                    if value is True or str(value).lower() in ['true', '1', 'yes']:
-                        # Draw checkmark
-                        draw_checkmark(page, rect)
-                else:
-                    # Insert text
-                    insert_text_in_box(page, rect, str(value))
-            
-            # Save modified PDF
-            doc.save(output_path)
-            doc.close()
-            
-            # Return file
-            return FileResponse(
-                output_path,
-                media_type="application/pdf",
-                filename=f"filled_{file.filename}",
-                background=None
-            )
+        if not _has_overlay_values(data.get("values", {}), data.get("fieldMap", {})):
+            # Nothing to draw: skip the parse and re-save and hand back the original
+            pdf_bytes = await _read_upload(file, hasher)
+        elif file.size is not None and file.size > PDF_IN_MEMORY_MAX:
+            # Large PDFs are spooled straight to disk and opened from there:
+            # MuPDF reads only the objects it needs and no in-memory copy is made
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_path = os.path.join(tmp_dir, "upload.pdf")
+                with open(tmp_path, 'wb') as tmp:
+                    await run_in_threadpool(_spool, file.file, tmp, hasher)
+                pdf_bytes = await loop.run_in_executor(_EXECUTOR, _overlay_sync, tmp_path, data, hasher.digest())
+        else:
+            # PyMuPDF work runs on the document executor, off the event loop
+            contents = await _read_upload(file, hasher)
+            pdf_bytes = await loop.run_in_executor(_EXECUTOR, _overlay_sync, contents, data, hasher.digest())
         
-        finally:
-            if os.path.exists(tmp_in_path):
-                os.unlink(tmp_in_path)
-            # Note: output_path will be cleaned up by FileResponse
+        # Return file
+        return Response(
+            content=pdf_bytes,
+            media_type="application/pdf",
+            headers={"Content-Disposition": _content_disposition(f"filled_{file.filename}")}
+        )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF overlay failed: {str(e)}")
 
 
-def draw_checkmark(page: fitz.Page, rect: fitz.Rect):
-    """Draw a checkmark in the given rectangle"""
-    # Calculate checkmark points
-    x1, y1 = rect.x0 + rect.width * 0.2, rect.y0 + rect.height * 0.5
-    x2, y2 = rect.x0 + rect.width * 0.4, rect.y0 + rect.height * 0.7
-    x3, y3 = rect.x0 + rect.width * 0.8, rect.y0 + rect.height * 0.3
-    
-    # Draw checkmark
-    shape = page.new_shape()
-    shape.draw_polyline([(x1, y1), (x2, y2), (x3, y3)])
-    shape.finish(color=(0, 0, 0), width=1.5)
-    shape.commit()
+def _has_overlay_values(values: Dict[str, Any], field_map: Dict[str, Dict]) -> bool:
+    """Whether any value would be drawn: non-empty (False counts) and present in the fieldMap"""
+    return any(
+        value is not None and value != "" and field_id in field_map
+        for field_id, value in values.items()
+    )
 
 
-def insert_text_in_box(page: fitz.Page, rect: fitz.Rect, text: str):
-    """Insert text into a box, scaling to fit"""
-    if not text:
-        return
-    
-    # Start with reasonable font size
-    font_size = 10
-    font_name = "helv"  # Helvetica
+# Content hash -> the template re-serialized after PyMuPDF repaired it, sized
+# in bytes. The same blank form is typically overlaid many times; a damaged
+# one would otherwise be rebuilt from a full file scan on every request.
+# Only touched from the document executor, so no lock
+_TEMPLATE_CACHE = _LRUCache(TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_BYTES)
+
+
+def _overlay_sync(upload: Union[str, bytes], data: Dict[str, Any], digest: bytes) -> bytes:
+    """
+    Blocking body of /overlay: draw the filled values onto the PDF, return the new PDF
+    upload: the PDF bytes, or the path of a temp copy owned by this request
+    """
+    source = upload
+    template = _TEMPLATE_CACHE.get(digest)
+    if template is not None:
+        source = template
+    upload_size = len(upload) if isinstance(upload, bytes) else os.path.getsize(upload)
     
-    # Try to fit text in box
-    while font_size > 6:
-        text_width = fitz.get_text_length(text, fontname=font_name, fontsize=font_size)
-        if text_width <= rect.width * 0.95:
-            break
-        font_size -= 0.5
-    
-    # Calculate vertical center
-    text_y = rect.y0 + (rect.height + font_size) / 2
-    
-    # Insert text
-    page.insert_text(
-        (rect.x0 + 2, text_y),
-        text,
-        fontsize=font_size,
-        fontname=font_name,
-        color=(0, 0, 0)
-    )
+    with contextlib.ExitStack() as cleanup:
+        if isinstance(source, bytes) and len(source) > PDF_IN_MEMORY_MAX:
+            # Large PDFs are opened from a temp file so the result can be
+            # saved incrementally instead of rewriting every unchanged page
+            tmp_dir = cleanup.enter_context(tempfile.TemporaryDirectory())
+            tmp_path = os.path.join(tmp_dir, "original.pdf")
+            with open(tmp_path, 'wb') as tmp:
+                tmp.write(source)
+            source = tmp_path
+        doc = open_pdf(source)
+        cleanup.callback(doc.close)
+        
+        if template is None and doc.is_repaired and upload_size <= TEMPLATE_MAX_BYTES:
+            repaired = doc.tobytes()
+            _TEMPLATE_CACHE.put(digest, repaired, len(repaired))
+        
+        # Get values and fieldMap
+        values = data.get("values", {})
+        field_map = data.get("fieldMap", {})
+        
+        # Counts and a few ids only: formatting the whole values dict costs
+        # megabytes of string on large forms
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Processing %d values (sample ids: %s); field map has %d fields",
+                len(values), list(itertools.islice(values, 5)), len(field_map)
+            )
+        
+        fields_by_page = plan_overlay(values, field_map, len(doc))
+        if not fields_by_page:
+            if isinstance(upload, str):
+                with open(upload, 'rb') as original:
+                    return original.read()
+            return upload
+        
+        # Draw every field, sharding large multi-page jobs across processes
+        apply_overlay(doc, fields_by_page)
+        
+        if isinstance(source, str) and doc.can_save_incrementally():
+            # Append only the new and changed objects to the original bytes
+            doc.save(source, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+            with open(source, 'rb') as result:
+                return result.read()
+        
+        # Serialize the modified PDF in memory: drop unused objects and
+        # compress the new content streams
+        return doc.tobytes(garbage=1, deflate=True)
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker loads its own PaddleOCR model, so scale out with
+    # WEB_CONCURRENCY only where memory allows
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    # A single worker serves this already-imported app; an import string
+    # would load main.py (and its model) a second time in this process.
+    # Worker processes need the import string to load the app themselves
+    uvicorn.run(
+        app if workers == 1 else "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
@@ -0,0 +1,325 @@
+"""
+Overlay drawing: plan filled values onto PDF pages and draw them
+
+Kept apart from main.py so the worker processes that draw large overlays
+import only PyMuPDF and this module, never the OCR model
+"""
+import concurrent.futures
+import functools
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Overlays with at least this many fields (over 4+ pages) are drawn in worker processes
+OVERLAY_PARALLEL_MIN_FIELDS = 64
+
+
+@dataclass(slots=True, frozen=True)
+class FieldInfo:
+    """A fieldMap entry resolved for drawing"""
+    page: int  # 0-indexed
+    rect: Tuple[float, float, float, float]  # (x0, y0, x1, y1) in PDF points
+    ftype: str
+
+
+def plan_overlay(values: Dict[str, Any], field_map: Dict[str, Dict], page_count: int) -> Dict[int, List[Tuple[Any, FieldInfo]]]:
+    """
+    Work out what to draw where: { page_num (0-indexed): [(value, FieldInfo)] }
+    Each fieldMap entry is read once here. Pages come in ascending order, so
+    drawing visits each page once, front to back, however the values were ordered
+    """
+    # Pick out the fields to draw; their bboxes are converted together below
+    to_draw = []
+    bboxes = []
+    scales = []
+    unscaled = 0
+    # Bound once: this loop runs per filled value, thousands of times on big forms
+    lookup = field_map.get
+    debug = logger.debug
+    add_draw, add_bbox, add_scale = to_draw.append, bboxes.append, scales.append
+    for field_id, value in values.items():
+        # Skip only if value is None or empty string (False is kept for checkboxes)
+        if value is None or value == "":
+            continue
+            
+        field_info = lookup(field_id)
+        if field_info is None:
+            debug("Field %s not in field_map", field_id)
+            continue
+        
+        debug("Processing field %s with value %s", field_id, value)
+        
+        get = field_info.get
+        page_num = get("page", 1) - 1  # 0-indexed
+        
+        if page_num >= page_count:
+            debug("Page %d out of range", page_num)
+            continue
+        
+        bbox = get("bbox", [])
+        
+        if len(bbox) != 8:
+            debug("Invalid bbox length: %d", len(bbox))
+            continue
+        
+        # Pages are rendered at different scales, so a bbox without its
+        # scale can't be placed; guessing one would shift the value
+        scale = get("dpi_scale")
+        if not scale:
+            unscaled += 1
+            continue
+        
+        add_draw((value, page_num, get("type", "text_field")))
+        add_bbox(bbox)
+        add_scale(scale)
+    
+    if unscaled:
+        logger.warning("Skipped %d fields without a dpi_scale in the field map", unscaled)
+    
+    # OCR bboxes [x1,y1,x2,y2,x3,y3,x4,y4] are in rendered pixels: take the
+    # enclosing rect and divide by the page's render scale, for all fields at once
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 8)
+    scale = np.asarray(scales, dtype=np.float64)
+    # Zipping the four columns yields each field's (x0, y0, x1, y1) tuple directly
+    rects = zip(
+        (np.minimum(boxes[:, 0], boxes[:, 6]) / scale).tolist(),
+        (np.minimum(boxes[:, 1], boxes[:, 3]) / scale).tolist(),
+        (np.maximum(boxes[:, 2], boxes[:, 4]) / scale).tolist(),
+        (np.maximum(boxes[:, 5], boxes[:, 7]) / scale).tolist()
+    )
+    
+    fields_by_page: Dict[int, List[Tuple[Any, FieldInfo]]] = {}
+    for (value, page_num, field_type), rect in zip(to_draw, rects):
+        fields_by_page.setdefault(page_num, []).append((value, FieldInfo(page_num, rect, field_type)))
+    
+    return {page_num: fields_by_page[page_num] for page_num in sorted(fields_by_page)}
+
+
+# Checkbox values (lowercased) that mean ticked, besides True itself
+_CHECKBOX_TRUE = frozenset(("true", "1", "yes"))
+
+
+def _is_checked(value: Any) -> bool:
+    """Whether a checkbox value means ticked: True, 1, or "true"/"1"/"yes" in any case"""
+    return value is True or str(value).lower() in _CHECKBOX_TRUE
+
+
+def _draw_fields(page: fitz.Page, page_num: int, fields: List[Tuple[Any, FieldInfo]]):
+    """Draw one page's planned fields: checkmarks for ticked checkboxes, text for the rest"""
+    # Sort the fields into vector and text work first, so each kind goes
+    # into its own shape and reaches the content stream in one append
+    checks = []
+    texts = []
+    Rect = fitz.Rect
+    debug = logger.debug
+    for value, info in fields:
+        rect = Rect(info.rect)
+        
+        debug("Drawing at rect %s on page %d", rect, page_num)
+        
+        # Handle different field types
+        if info.ftype == "checkbox":
+            if _is_checked(value):
+                checks.append(rect)
+        else:
+            texts.append((rect, str(value)))
+    
+    if checks:
+        shape = page.new_shape()
+        for rect in checks:
+            draw_checkmark(shape, rect)
+        shape.commit()
+    
+    if texts:
+        shape = page.new_shape()
+        ascender = _helv_ascender(page)
+        for rect, text in texts:
+            insert_text_in_box(shape, rect, text, ascender)
+        shape.commit()
+
+
+def _overlay_page_shard(args: Tuple[int, float, float, List[Tuple[Any, FieldInfo]]]) -> bytes:
+    """
+    Pool worker: draw one page's fields onto a blank page of the same size
+    Returns it as a one-page PDF for the parent to stamp onto the original
+    """
+    page_num, width, height, fields = args
+    doc = fitz.open()
+    try:
+        _draw_fields(doc.new_page(width=width, height=height), page_num, fields)
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+# Worker processes for large overlays, started on first use
+_OVERLAY_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+def _pool_size() -> int:
+    """Overlay processes for this server process; every uvicorn worker shares the cores"""
+    return max(1, multiprocessing.cpu_count() // int(os.environ.get("WEB_CONCURRENCY", 1)))
+
+
+def shutdown_pool() -> None:
+    """Stop the overlay worker processes, if any were started"""
+    global _OVERLAY_POOL
+    if _OVERLAY_POOL is not None:
+        _OVERLAY_POOL.shutdown()
+        _OVERLAY_POOL = None
+
+
+def apply_overlay(doc: fitz.Document, fields_by_page: Dict[int, List[Tuple[Any, FieldInfo]]]):
+    """
+    Draw the planned fields into doc
+    Drawing is CPU-bound, so large multi-page overlays are drawn a page per
+    worker process on blank pages, which are then stamped onto the original
+    pages (show_pdf_page keeps their existing widgets and annotations intact)
+    """
+    global _OVERLAY_POOL
+    
+    cpu = min(_pool_size(), len(fields_by_page))
+    field_count = sum(len(fields) for fields in fields_by_page.values())
+    
+    # Small overlays: shipping pages to workers costs more than it saves
+    if len(fields_by_page) < 4 or cpu < 2 or field_count < OVERLAY_PARALLEL_MIN_FIELDS:
+        for page_num, fields in fields_by_page.items():
+            _draw_fields(doc[page_num], page_num, fields)
+        return
+    
+    if _OVERLAY_POOL is None:
+        # The caller is a thread of a multithreaded server process, so no
+        # fork. Workers come from a fork server that has only imported this
+        # module: they never load the OCR model
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        _OVERLAY_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=_pool_size(), mp_context=context)
+    
+    page_nums = []
+    shards = []
+    for page_num, fields in fields_by_page.items():
+        page = doc[page_num]
+        if page.rotation:
+            # PyMuPDF places text on rotated pages relative to the unrotated
+            # (and possibly cropped) page; only the original page reproduces that
+            _draw_fields(page, page_num, fields)
+            continue
+        page_nums.append(page_num)
+        shards.append((page_num, page.rect.width, page.rect.height, fields))
+    
+    stamped = 0
+    try:
+        for page_num, shard_pdf in zip(page_nums, _OVERLAY_POOL.map(_overlay_page_shard, shards)):
+            src = fitz.open(stream=shard_pdf, filetype="pdf")
+            try:
+                page = doc[page_num]
+                page.show_pdf_page(page.rect, src, 0)
+            finally:
+                src.close()
+            stamped += 1
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed) and a broken pool never recovers:
+        # drop it so the next large overlay starts a fresh one, and draw the
+        # pages not yet stamped here
+        logger.warning("Overlay worker process died; drawing %d pages in process", len(shards) - stamped)
+        shutdown_pool()
+        for page_num, _, _, fields in shards[stamped:]:
+            _draw_fields(doc[page_num], page_num, fields)
+
+
+def draw_checkmark(shape: fitz.utils.Shape, rect: fitz.Rect):
+    """Add a checkmark in the given rectangle to the page's shared checkmark shape"""
+    # Calculate checkmark points
+    x1, y1 = rect.x0 + rect.width * 0.2, rect.y0 + rect.height * 0.5
+    x2, y2 = rect.x0 + rect.width * 0.4, rect.y0 + rect.height * 0.7
+    x3, y3 = rect.x0 + rect.width * 0.8, rect.y0 + rect.height * 0.3
+    
+    shape.draw_polyline([(x1, y1), (x2, y2), (x3, y3)])
+    shape.finish(color=(0, 0, 0), width=1.5)
+
+
+# Helvetica is resolved once, for measuring text widths only. Vertical
+# placement uses the page's helv resource instead (see _helv_ascender)
+_FONT = fitz.Font("helv")
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_unit_width(text: str) -> float:
+    """Width of text at 1pt; form values repeat a lot (ticks, dates, states)"""
+    return _FONT.text_length(text, fontsize=1)
+
+
+def _helv_ascender(page: fitz.Page) -> float:
+    """
+    Ascender of the page's helv font resource: insert_textbox puts the first
+    baseline this many font sizes below the box top. A standalone Font's
+    metrics differ from those of a helv already written into the PDF (e.g. a
+    re-uploaded overlay result). Read the way insert_textbox reads it in
+    PyMuPDF 1.23.8, the pinned version; recheck when upgrading
+    """
+    return fitz.CheckFontInfo(page.parent, page.insert_font(fontname="helv"))[1]["ascender"]
+
+
+# Line height factor passed to insert_textbox, and the box height (in font
+# sizes) that holds one such line plus helv's descender (under 0.3) but not
+# a second line: a value too long for its field is then reported as a
+# deficit instead of being wrapped onto more lines, mid-word if need be
+_LINE_HEIGHT = 1.2
+_ONE_LINE_BOX = _LINE_HEIGHT + 0.5
+
+
+def insert_text_in_box(shape: fitz.utils.Shape, rect: fitz.Rect, text: str, ascender: float):
+    """
+    Add text fitted into a box to the page's shared text shape, scaling to fit
+    ascender: the page's helv ascender, from _helv_ascender
+    """
+    if not text:
+        return
+    
+    # Start with reasonable font size
+    font_size = 10
+    font_name = "helv"  # Helvetica
+    
+    # Shrink in 0.5pt steps (down to 6pt) until the text fits the box, after
+    # its 2pt left inset. Glyph widths scale linearly with font size, so one
+    # measurement is enough
+    target_width = min(rect.width * 0.95, rect.width - 2)
+    text_width = _text_unit_width(text) * font_size
+    if text_width > target_width:
+        font_size = max(6.0, math.floor(2 * font_size * target_width / text_width) / 2)
+    
+    # Lay the value out as one line in the field inset 2pt from the left, with
+    # the box top placed so the baseline lands on the vertical centre;
+    # insert_textbox keeps the text inside it and reports a deficit instead
+    # of spilling over
+    text_y = rect.y0 + (rect.height + font_size) / 2
+    top = text_y - ascender * font_size
+    box = fitz.Rect(rect.x0 + 2, top, rect.x1, top + _ONE_LINE_BOX * font_size)
+    rc = shape.insert_textbox(
+        box,
+        text,
+        fontsize=font_size,
+        fontname=font_name,
+        color=(0, 0, 0),
+        align=fitz.TEXT_ALIGN_LEFT,
+        lineheight=_LINE_HEIGHT
+    )
+    
+    # Still too long at the minimum size: draw it unclipped rather than drop it
+    if rc < 0:
+        shape.insert_text(
+            (rect.x0 + 2, text_y),
+            text,
+            fontsize=font_size,
+            fontname=font_name,
+            color=(0, 0, 0)
+        )